@@ -2,10 +2,10 @@
 from typing import Tuple
 
 import bottleneck
+import numba
 import numpy as np
+import scipy.fft as sfft
 import scipy.sparse as spr
-import scipy.stats as sts
-from scipy.signal import fftconvolve
 
 from triku.logg import TRIKU_LEVEL
 from triku.logg import triku_logger
@@ -15,6 +15,77 @@ from triku.logg import triku_logger
 # from triku.genutils import TqdmToLogger
 
 
+def binarize_neighbour_mask(mat) -> spr.csr.csr_matrix:
+    """
+    Returns the boolean neighbour mask: the nonzero entries of mat plus the own
+    cell (the diagonal). Doing (mat > 0) + spr.identity(...) allocates the
+    binarized copy, the identity and the added result, and the sparse addition
+    re-sorts every row; instead, the diagonal is spliced into the csr structure
+    directly, building the final indices and data in one allocation each. The
+    own cell is stored first in each row, as in the 'conn' construction; scanpy
+    neighbour arrays never store the own cell, so no duplicates can appear.
+    """
+    mat = mat.tocsr()
+    n_cells = mat.shape[0]
+
+    # int32 indexing covers any realistic cell count (< 2**31) and halves the
+    # memory and cache traffic of the mask compared with the int64 default.
+    indptr = (mat.indptr + np.arange(n_cells + 1)).astype(np.int32)
+    indices = np.empty(len(mat.indices) + n_cells, dtype=np.int32)
+
+    diag_pos = indptr[:-1]
+    indices[diag_pos] = np.arange(n_cells)
+    offdiag_mask = np.ones(len(indices), dtype=bool)
+    offdiag_mask[diag_pos] = False
+    indices[offdiag_mask] = mat.indices
+
+    data = np.ones(len(indices), dtype=bool)
+
+    return spr.csr.csr_matrix(
+        (data, indices, indptr), shape=(n_cells, n_cells)
+    )
+
+
+@numba.njit(parallel=True, cache=True)
+def top_knn_per_row(
+    conn_data: np.ndarray,
+    conn_indices: np.ndarray,
+    conn_indptr: np.ndarray,
+    dist_indices: np.ndarray,
+    dist_indptr: np.ndarray,
+    knn: int,
+) -> np.ndarray:
+    """
+    Walks the csr rows of the connectivities array and selects, for each cell,
+    the knn - 1 neighbours with the highest connectivity (plus the own cell,
+    stored first). Rows with fewer than knn connected cells fall back to the
+    distances neighbours. Rows are independent, so they are processed in
+    parallel with prange; no dense intermediate is ever built.
+    """
+    n_cells = len(conn_indptr) - 1
+    knn_array_indices = np.ones(n_cells * knn, dtype=np.int32)
+
+    for row in numba.prange(n_cells):
+        start_conn, end_conn = conn_indptr[row], conn_indptr[row + 1]
+        knn_array_indices[row * knn] = row
+
+        if end_conn - start_conn >= knn:
+            order = np.argsort(-conn_data[start_conn:end_conn])
+            for k in range(knn - 1):
+                knn_array_indices[row * knn + 1 + k] = conn_indices[
+                    start_conn + order[k]
+                ]
+        else:  # Sometimes the number of neighbors, based on connectivities, is smaller.
+            # We fallback to distances in that case. The number of cases is very small.
+            start_dist, end_dist = dist_indptr[row], dist_indptr[row + 1]
+            for k in range(min(knn - 1, end_dist - start_dist)):
+                knn_array_indices[row * knn + 1 + k] = dist_indices[
+                    start_dist + k
+                ]
+
+    return knn_array_indices
+
+
 def return_knn_array(object_triku, dist_conn, knn):
     # Distances array contains a pairwise relationship between cells, based on distance.
     # We will binarize that array to select equally all components with non-zero distance.
@@ -24,13 +95,10 @@ def return_knn_array(object_triku, dist_conn, knn):
         # To add the own cell we use spr.identity.
 
         if dist_conn == "dist":
-            knn_array = (
+            knn_array = binarize_neighbour_mask(
                 object_triku.obsp[  # type:ignore
                     "distances"
                 ]
-                > 0
-            ) + spr.identity(len(object_triku)).astype(
-                bool
             )  # Saves memory
 
         elif dist_conn == "conn":
@@ -40,48 +108,39 @@ def return_knn_array(object_triku, dist_conn, knn):
             # To make the process faster we construct the array from zero by setting indptr, indexes and data.
             # 1) Indptr are 0, knn, 2*knn, 3*knn, 4*knn, ...
             # 2) Data are 1 throughout the array.
-            # 3) The indices of the best connectivities are selected via argsort of the best values (selected in object_triku.obsp["connectivities"].data)
+            # 3) The indices of the best connectivities are selected per row with the
+            #    top_knn_per_row kernel (knn - 1 because the own index is not within the best).
 
-            knn_array_conn_indices = np.ones(
-                len(object_triku) * knn, dtype=int
-            )
             knn_array_conn_data = np.ones(len(object_triku) * knn, dtype=bool)
             knn_array_conn_indptr = np.arange(
-                0, (len(object_triku) + 1) * knn, knn
+                0, (len(object_triku) + 1) * knn, knn, dtype=np.int32
             )
 
-            for row in range(len(object_triku)):
-                start_counts, end_counts = (
-                    object_triku.obsp["connectivities"].indptr[row],
-                    object_triku.obsp["connectivities"].indptr[row + 1],
-                )
-                data_row = object_triku.obsp["connectivities"].data[
-                    start_counts:end_counts
-                ]
-                idx_row = object_triku.obsp["connectivities"].indices[
-                    start_counts:end_counts
-                ]
+            conn_csr = object_triku.obsp["connectivities"].tocsr()
 
-                if (
-                    len(data_row) >= knn
-                ):  # bottleneck works much faster, but it requires that the number of connected features be >= knn.
-                    # If not (because there are some), it fails. Then, it goes to the classical argsort, which is slower but effective.
-                    argidx = bottleneck.argpartition(-data_row, knn - 1)
-                    idx_pos = idx_row[
-                        argidx[: knn - 1]
-                    ]  # knn - 1 because the own index is not within the best
-                else:  # Sometimes the number of neighbors, based on connectivities, is smaller, and it fails. We fallback to distances in that case. The number of
-                    # cases is very small in that case.
-                    idx_pos = object_triku.obsp["distances"].indices[
-                        object_triku.obsp["distances"]
-                        .indptr[row] : object_triku.obsp["distances"]
-                        .indptr[row + 1]
-                    ]
-
-                knn_array_conn_indices[row * knn] = row
-                knn_array_conn_indices[
-                    row * knn + 1 : (row + 1) * knn
-                ] = idx_pos
+            if np.all(np.diff(conn_csr.indptr) == knn - 1):
+                # When every row holds exactly knn - 1 neighbours the top-(knn - 1)
+                # selection is the row itself, so the whole construction collapses
+                # to interleaving the own cell with a reshape of conn.indices.
+                knn_array_conn_indices = np.empty(
+                    (len(object_triku), knn), dtype=np.int32
+                )
+                knn_array_conn_indices[:, 0] = np.arange(len(object_triku))
+                knn_array_conn_indices[:, 1:] = conn_csr.indices.reshape(
+                    -1, knn - 1
+                )
+                knn_array_conn_indices = knn_array_conn_indices.ravel()
+            else:
+                dist_csr = object_triku.obsp["distances"].tocsr()
+
+                knn_array_conn_indices = top_knn_per_row(
+                    conn_csr.data,
+                    conn_csr.indices,
+                    conn_csr.indptr,
+                    dist_csr.indices,
+                    dist_csr.indptr,
+                    knn,
+                )
 
             knn_array = spr.csr.csr_matrix(
                 (
@@ -102,21 +161,26 @@ def return_knn_array(object_triku, dist_conn, knn):
         In future versions of triku we will select these matrices from .obsp exclusively."""
         )
 
-        knn_array = (
+        knn_array = binarize_neighbour_mask(
             object_triku.uns[  # type:ignore
                 "neighbors"
             ][
                 "connectivities"
             ]
-            > 0
-        ) + spr.identity(len(object_triku)).astype(
-            bool
         )  # Saves memory
 
     return knn_array
 
 
 def get_n_divisions(arr_counts: spr.csr.csr_matrix) -> int:
+    if np.issubdtype(arr_counts.dtype, np.integer):
+        # An integer dtype cannot hold fractional counts, so the O(nnz) floor
+        # comparison below is not needed at all.
+        triku_logger.log(
+            TRIKU_LEVEL, "Number of divisions set to 1 (integer dtype)"
+        )
+        return 1
+
     diff = np.abs(
         (arr_counts - arr_counts.floor()).sum()
     )  # Faster .floor() than X.astype(int) (up to x2 for large arrays)
@@ -168,85 +232,297 @@ def return_knn_expression(
     return knn_expression
 
 
-def compute_conv_idx(
-    counts_gene: np.ndarray, knn: int, p_zeros: float,
-) -> Tuple[np.ndarray, np.ndarray]:
+@numba.njit(cache=True, fastmath=True)
+def direct_convolve(
+    arr_a: np.ndarray,
+    len_a: int,
+    arr_b: np.ndarray,
+    len_b: int,
+    arr_out: np.ndarray,
+) -> int:
     """
-    Given a GENE x CELL matrix, and an index to select from, calculates the convolution of reads for that gene index.
-    The function returns the
+    Direct-sum convolution of the first len_a values of arr_a with the first
+    len_b values of arr_b, written into arr_out (which must be large enough).
+    Returns the length of the result.
     """
-    y_probs = np.bincount(counts_gene) / len(
-        counts_gene
-    )  # Important to transform count to probabilities
-    # to keep the convolution constant.
-    # THIS y_probs MUST have the probs of P(X=0) because the
-    # random neighbors might have 0 counts!!!  [TODO: check this!!!]
-
-    # We are calculating the convolution of cells with positive expression. Thus, in the first distribution
-    # we have to remove the cells with 0 reads, and rescale the probabilities.
-    y_probs_0 = np.bincount(counts_gene) / len(counts_gene)
-    y_probs = y_probs_0.copy() * (1 - p_zeros)
-    y_probs[0] = p_zeros
+    len_out = len_a + len_b - 1
+
+    for i in range(len_out):
+        arr_out[i] = 0.0
+
+    for i in range(len_a):
+        v = arr_a[i]
+        if v != 0.0:
+            for j in range(len_b):
+                arr_out[i + j] += v * arr_b[j]
+
+    return len_out
 
+
+@numba.njit(cache=True, fastmath=True)
+def conv_chain(y_probs_0: np.ndarray, y_probs: np.ndarray, knn: int):
     """
-    Reynolds
-    len(y_probs)        scp.fftconvolve     scp.convolve     np.convolve
-    6783                52                  52.5             2000
-    5129                41                  43               933
-    3072                23.5                23.6             334
-    1783                14.5                15.3             129
-    1202                10.3                13.4             59.4
-    669                 6.6                 22.2             20.8
-    298                 4.19                5.32             5.18
-    237                 3.74                3.48             3.23
-    188                 3.54                2.98             2.78
-    159                 3.11                1.95             1.63
-    117                 2.93                1.41             1.12
-    52                  2.33                0.8              0.63
-    34                  2.77                0.75             0.41
-    19                  1.98                0.61             0.23
-    13                  1.94                0.45             0.27
-    8                   1.83                0.55             0.19
-    PBMC 10k
-    len(y_probs)        scp.fftconvolve     scp.convolve     np.convolve
-    4123                31.4                32.1             604
-    1324                11.1                12.1             45.5
-    885                 7.98                15.1             33.8
-    725                 6.98                13.1             14.9
-    551                 5.8                 15               14.4
-    345                 4.3                 7.1              6.7
-    255                 3.6                 3.9              3.7
-    190                 3.3                 2.7              2.3
-    119                 2.7                 1.7              1.5
-    70                  2.7                 0.9              0.84
-    36                  2.1                 0.6              0.3
-    20                  2.1                 0.5              0.2
+    Returns y_probs_0 convolved with y_probs knn times. np.convolve would
+    re-enter the interpreter and allocate a new output array on each of the knn
+    calls; here the chain runs fully compiled on two ping-pong buffer pairs
+    sized for the final support, so nothing is allocated inside the loop. For
+    the small supports this function is called with (<= 250 bins) the direct
+    sum beats FFT-based convolution by a wide margin.
+
+    Instead of applying y_probs knn times sequentially, the power is built by
+    squaring (y_probs -> y_probs**2 -> y_probs**4 -> ...), so the chain takes
+    ~log2(knn) + popcount(knn) convolutions, mirroring the pointwise
+    rfft(y_probs)**knn of the batched FFT path.
+
+    The buffers are float32: the convolved probabilities carry far more
+    precision than the EMD needs (only the relative ranking of the distances
+    matters downstream), and halving the element size doubles the SIMD lane
+    count and halves the memory traffic of the inner loop.
     """
+    len_probs = len(y_probs)
+    len_out = len(y_probs_0) + knn * (len_probs - 1)
+
+    # Result buffers, initialized with y_probs_0; base buffers holding
+    # y_probs**(2**k). Both powers stay below len_out, so one size fits all.
+    res_src = np.zeros(len_out, dtype=np.float32)
+    res_dst = np.zeros(len_out, dtype=np.float32)
+    res_src[: len(y_probs_0)] = y_probs_0
+    len_res = len(y_probs_0)
+
+    base_src = np.zeros(len_out, dtype=np.float32)
+    base_dst = np.zeros(len_out, dtype=np.float32)
+    base_src[:len_probs] = y_probs
+    len_base = len_probs
+
+    exponent = knn
+    while exponent > 0:
+        if exponent & 1:
+            len_res = direct_convolve(
+                res_src, len_res, base_src, len_base, res_dst
+            )
+            res_src, res_dst = res_dst, res_src
 
-    if (
-        len(y_probs) > 250
-    ):  # This is important. For some genes, if the counts are too big, np.convolve crashes!!
-        func = fftconvolve
-    else:
-        func = np.convolve
+        exponent >>= 1
+        if exponent > 0:
+            len_base = direct_convolve(
+                base_src, len_base, base_src, len_base, base_dst
+            )
+            base_src, base_dst = base_dst, base_src
 
-    arr_convolve = func(
-        y_probs_0, y_probs
-    )  # First iteration always with itself
+    return res_src[:len_res]
 
-    for _ in range(knn - 1):
-        arr_convolve = func(arr_convolve, y_probs,)
 
-    arr_prob = (
-        arr_convolve / arr_convolve.sum()
-    )  # This is just in case the sum is bigger than 1
+@numba.njit(cache=True, fastmath=True)
+def normalized_emd(
+    real_vals: np.ndarray, y_conv: np.ndarray, n_divisions: int
+) -> float:
+    """
+    Earth movers distance between the real knn counts distribution and the
+    convolution, normalized by the standard deviation of the convolution. Both
+    distributions are given as probabilities on the integer grid 0, 1, 2, ...
+    (scaled back by n_divisions), so the EMD is simply the L1 distance between
+    the two CDFs. scipy.stats.wasserstein_distance gives the same distance, but
+    it re-sorts and merges the supports on every call, and it cannot be called
+    from nopython code.
+
+    The CDFs and the first and second moments of the convolution are all
+    accumulated in the same pass, so no x grid or centered temporary arrays are
+    materialized (variance = E[x^2] - E[x]^2).
+    """
+    len_max = max(len(real_vals), len(y_conv))
+
+    cdf_real, cdf_conv, emd = 0.0, 0.0, 0.0
+    sum_xy, sum_x2y = 0.0, 0.0
+    for i in range(len_max):
+        if i < len(real_vals):
+            cdf_real += real_vals[i]
+        if i < len(y_conv):
+            x = i / n_divisions
+            cdf_conv += y_conv[i]
+            sum_xy += x * y_conv[i]
+            sum_x2y += x * x * y_conv[i]
+        emd += abs(cdf_real - cdf_conv)
+
+    var = sum_x2y - sum_xy * sum_xy
+    if var <= 0:
+        return 0.0
+
+    return emd / n_divisions / np.sqrt(var)
+
+
+@numba.njit(cache=True, fastmath=True)
+def normalized_emd_constant(
+    knn_value: int, y_conv: np.ndarray, n_divisions: int
+) -> float:
+    """
+    Degenerate case of normalized_emd where every expressing cell has the same
+    knn count: against a point mass at v the EMD is exactly E|X - v| under the
+    convolution, so the knn counts histogram and the CDF accumulation are
+    skipped. Low-expression genes hit this case often in sparse datasets.
+    """
+    v = knn_value / n_divisions
 
-    # Important because some convolutions yield negative close-to-zero values that break emd
-    arr_prob[np.isclose(arr_prob, 0, atol=1e-10)] = 0
+    emd, sum_xy, sum_x2y = 0.0, 0.0, 0.0
+    for i in range(len(y_conv)):
+        x = i / n_divisions
+        emd += y_conv[i] * abs(x - v)
+        sum_xy += x * y_conv[i]
+        sum_x2y += x * x * y_conv[i]
+
+    var = sum_x2y - sum_xy * sum_xy
+    if var <= 0:
+        return 0.0
+
+    return emd / np.sqrt(var)
+
+
+@numba.njit(cache=True, fastmath=True)
+def compute_emd_gene(
+    counts_gene: np.ndarray,
+    knn_counts: np.ndarray,
+    knn: int,
+    n_divisions: int,
+    p_zeros: float,
+    counts_bins: np.ndarray,
+    knn_bins: np.ndarray,
+    max_count: int,
+) -> float:
+    """
+    Compiled counterpart of compute_conv_idx + calculate_emd for genes with a
+    small support (<= 250 bins): convolution of the read count distribution,
+    clipping of near-zero probabilities, and normalized EMD against the knn
+    counts, all in nopython mode so that the caller can run it under prange.
+
+    counts_bins and knn_bins are per-thread scratch rows for the two histograms;
+    only the range a gene actually uses is zeroed, so the buffers stay warm in
+    cache across genes instead of hitting the allocator twice per gene.
+    """
+    n_expressing = len(counts_gene)
+
+    counts_bins[: max_count + 1] = 0
+    for i in range(n_expressing):
+        counts_bins[counts_gene[i]] += 1
+
+    y_probs_0 = (counts_bins[: max_count + 1] / n_expressing).astype(
+        np.float32
+    )
+    y_probs = y_probs_0 * np.float32(1 - p_zeros)
+    y_probs[0] = p_zeros
+
+    arr_prob = conv_chain(y_probs_0, y_probs, knn)
+    arr_prob /= arr_prob.sum()
 
-    x_conv, y_conv = np.arange(len(arr_prob)), arr_prob
+    # Important because some convolutions yield negative close-to-zero values that break emd
+    for i in range(len(arr_prob)):
+        if abs(arr_prob[i]) < 1e-10:
+            arr_prob[i] = 0.0
+
+    max_knn_count = 0
+    min_knn_count = knn_counts[0]
+    for i in range(n_expressing):
+        if knn_counts[i] > max_knn_count:
+            max_knn_count = knn_counts[i]
+        if knn_counts[i] < min_knn_count:
+            min_knn_count = knn_counts[i]
+
+    if min_knn_count == max_knn_count:
+        # All expressing cells share the same knn count; no histogram needed.
+        return normalized_emd_constant(min_knn_count, arr_prob, n_divisions)
+
+    if max_knn_count < len(knn_bins):
+        knn_bins[: max_knn_count + 1] = 0
+        for i in range(n_expressing):
+            knn_bins[knn_counts[i]] += 1
+        real_vals = knn_bins[: max_knn_count + 1] / n_expressing
+    else:
+        # knn graphs with more neighbours per row than n_neighbors (e.g. bbknn)
+        # can exceed the scratch bound; fall back to an allocating bincount.
+        real_vals = np.bincount(knn_counts) / n_expressing
+
+    return normalized_emd(real_vals, arr_prob, n_divisions)
+
+
+@numba.njit(parallel=True)
+def parallel_emd_calculation(
+    counts_data: np.ndarray,
+    counts_indices: np.ndarray,
+    counts_indptr: np.ndarray,
+    knn_data: np.ndarray,
+    knn_indices: np.ndarray,
+    knn_indptr: np.ndarray,
+    n_cells: int,
+    knn: int,
+    min_knn: int,
+    n_divisions: int,
+) -> np.ndarray:
+    """
+    Parallel EMD over genes. Takes the raw indices / indptr attributes of the
+    csc count and knn count arrays, plus the data attributes already binned to
+    integers (done once, vectorized, in emd_calculation — so each prange
+    iteration slices a contiguous, ready-to-use row with no per-gene scaling or
+    copy). Everything lives in shared memory, so there is no per-task
+    serialization cost and the work scales linearly with cores.
+
+    Genes whose count support is too long for the direct convolution kernel are
+    flagged with -1 and are computed by the caller with the fftconvolve path.
+    """
+    n_genes = len(counts_indptr) - 1
+    array_emd = np.zeros(n_genes, dtype=np.float64)
+
+    # Per-thread histogram scratch. The count support is capped at 250 bins by
+    # the gate below, and a knn count is a sum over at most knn neighbours plus
+    # the own cell, which bounds the knn counts support by 250 * (knn + 1) bins.
+    n_threads = numba.get_num_threads()
+    counts_bins = np.zeros((n_threads, 251), dtype=np.int64)
+    knn_bins = np.zeros((n_threads, 250 * (knn + 1)), dtype=np.int64)
+
+    for idx in numba.prange(n_genes):
+        start_counts, end_counts = counts_indptr[idx], counts_indptr[idx + 1]
+        start_knn, end_knn = knn_indptr[idx], knn_indptr[idx + 1]
+
+        n_expressing = end_counts - start_counts
+        if n_expressing < min_knn:
+            continue
+
+        counts_gene = counts_data[start_counts:end_counts]
+        max_count = 0
+        for i in range(n_expressing):
+            if counts_gene[i] > max_count:
+                max_count = counts_gene[i]
+
+        if max_count + 1 > 250:
+            array_emd[idx] = -1.0
+            continue
+
+        # The knn counts column contains the indices of the counts column + extra.
+        # Both index arrays are sorted, so the overlapping entries are extracted
+        # with a single two-pointer scan instead of np.isin.
+        knn_counts = np.zeros(n_expressing, dtype=np.int64)
+        ptr_knn = start_knn
+        for i in range(n_expressing):
+            target = counts_indices[start_counts + i]
+            while ptr_knn < end_knn and knn_indices[ptr_knn] != target:
+                ptr_knn += 1
+            if ptr_knn >= end_knn:
+                break
+            knn_counts[i] = knn_data[ptr_knn]
+            ptr_knn += 1
+
+        p_zeros = 1.0 + (start_counts - end_counts) / n_cells
+
+        thread_id = numba.get_thread_id()
+        array_emd[idx] = compute_emd_gene(
+            counts_gene,
+            knn_counts,
+            knn,
+            n_divisions,
+            p_zeros,
+            counts_bins[thread_id],
+            knn_bins[thread_id],
+            max_count,
+        )
 
-    return x_conv, y_conv
+    return array_emd
 
 
 def calculate_emd(
@@ -259,43 +535,44 @@ def calculate_emd(
     Returns "normalized" earth movers distance (EMD). The function calculates the x positions and probabilities
     of the "real" dataset using the knn_counts, and the x positions and probabilities of the convolution as attributes.
 
+    Both distributions live on the same integer grid (scaled back by n_divisions), so the
+    EMD is computed with the one-pass normalized_emd kernel instead of
+    scipy.stats.wasserstein_distance, which would re-sort and merge the supports on every call.
+
     To normalize the distance, it is divided by the standard deviation of the convolution. Since the convolution
-    is already given as a distribution, mean and variance have to be calculated "by hand".
+    is already given as a distribution, mean and variance are calculated inside the kernel,
+    fused with the CDF accumulation.
     """
-    dist_range = np.arange(np.max(knn_counts) + 1)
-    # np.bincount transforms [3, 3, 4, 1, 2, 9] into [0, 1, 1, 2, 1, 0, 0, 0, 0, 1]
-    real_vals = np.bincount(knn_counts) / len(knn_counts)
-
     # IMPORTANT: either for std or emd calculation, all x variables must be scaled back!
-    dist_range = dist_range / n_divisions
     x_conv = x_conv / n_divisions
 
-    emd = sts.wasserstein_distance(dist_range, x_conv, real_vals, y_conv)
+    if knn_counts.min() == knn_counts.max():
+        # All expressing cells share the same knn count; no histogram needed.
+        return (
+            x_conv,
+            normalized_emd_constant(knn_counts[0], y_conv, n_divisions),
+        )
 
-    mean = (x_conv * y_conv).sum()
-    std = np.sqrt((y_conv * (x_conv - mean) ** 2).sum())
+    # np.bincount transforms [3, 3, 4, 1, 2, 9] into [0, 1, 1, 2, 1, 0, 0, 0, 0, 1]
+    real_vals = np.bincount(knn_counts) / len(knn_counts)
 
-    return x_conv, emd / std
+    return x_conv, normalized_emd(real_vals, y_conv, n_divisions)
 
 
-def compute_convolution_and_emd(
+def return_gene_counts(
     array_counts_csc: spr.csc.csc_matrix,
     array_knn_counts_csc: spr.csc.csc_matrix,
+    counts_data: np.ndarray,
+    knn_data: np.ndarray,
     idx: int,
-    knn: int,
-    min_knn: int,
-    n_divisions: int,
-) -> np.ndarray:
-    """Calculate the convolution and emd given the array with counts and with knn counts.
-    To do the convolution we will select the gene column from each array.
+) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Selects the counts, the knn counts and the zero-count probability of a gene.
 
     From the array of counts we will simply select the values, and from the array of knn counts we will select the values
     of the indices from the array of counts (arr_counts[:, idx].indices).
 
-    Then, we are going to make the array integer. To do that, we recall the n_divisions argument, that applies
-    binning to the unit. For instance, if the expression of a gene is 5.23 and 5 bins are set, the new expression is
-    int(5.23 * 5) = int(26.15) = 26 -> 26 / 5 = 5.2 (so we lose 0.03 of expression).
-    This is a scaling step
+    counts_data and knn_data are the csc data attributes already made integer with the
+    n_divisions binning (see emd_calculation), so the per-gene slices need no scaling here.
 
     To do sparse array accession faster we will play with csr_matrix.data, csr_matrix.indptr and csr_matrix.indices attributes.
     This makes the code a bit obscure, but makes the selection faster (or at least guarantees it is not slower).
@@ -316,29 +593,104 @@ def compute_convolution_and_emd(
     indices_counts = array_counts_csc.indices[start_counts:end_counts]
     indices_counts_knn = array_knn_counts_csc.indices[start_knn:end_knn]
     # because indices_counts_knn array has the indices from indices_counts + extra, this line extracts the overlapping indices.
-    bool_mask = np.in1d(indices_counts_knn, indices_counts, assume_unique=True)
+    bool_mask = np.isin(indices_counts_knn, indices_counts, assume_unique=True)
+
+    counts_gene = counts_data[start_counts:end_counts]
+    knn_counts = knn_data[start_knn:end_knn][bool_mask]
+
+    # p_zeros is necessary because we don't have zeros in counts_gene, and we need them to create the probability
+    # distribution including zeros.
+    p_zeros = 1 + (start_counts - end_counts) / array_counts_csc.shape[0]
+
+    return counts_gene, knn_counts, p_zeros
 
-    counts_gene = array_counts_csc.data[start_counts:end_counts]
-    knn_counts = array_knn_counts_csc.data[start_knn:end_knn][bool_mask]
 
+def batched_fft_emd(
+    array_counts_csc: spr.csc.csc_matrix,
+    array_knn_counts_csc: spr.csc.csc_matrix,
+    counts_data: np.ndarray,
+    knn_data: np.ndarray,
+    idx_genes: np.ndarray,
+    knn: int,
+    n_divisions: int,
+) -> np.ndarray:
     """
-    The next step is to multiply the counts and knn_counts by n_divisions, and set it to int because otherwise the convolution fails.
+    EMD of the genes whose count support is too long for the direct convolution
+    kernel (> 250 bins, where FFT-based convolution wins over the direct sum).
+
+    These genes used to run knn sequential fftconvolve calls each; for short
+    signals the FFT setup and the Python dispatch dominate. Convolving the same
+    distribution knn times is a pointwise power in frequency space, so instead
+    the probability vectors are bucketed by the power-of-two FFT size that fits
+    their final support, each bucket is stacked into a 2D array, and the whole
+    bucket is transformed at once along one axis:
+
+        arr_conv = irfft(rfft(y_probs_0) * rfft(y_probs) ** knn)
+
+    One batched FFT pair per bucket replaces knn transforms per gene.
     """
+    list_y_probs_0, list_y_probs, list_knn_counts = [], [], []
 
-    counts_gene = (counts_gene * n_divisions).astype(int)
-    knn_counts = (knn_counts * n_divisions).astype(int)
+    for idx in idx_genes:
+        counts_gene, knn_counts, p_zeros = return_gene_counts(
+            array_counts_csc, array_knn_counts_csc, counts_data, knn_data, idx
+        )
 
-    # This part is necessary for compute_conv_idx, because we don't have zeros in counts_gene, and we need them to create the probability
-    # distribution including zeros.
-    p_zeros = 1 + (start_counts - end_counts) / array_counts_csc.shape[0]
+        y_probs_0 = (np.bincount(counts_gene) / len(counts_gene)).astype(
+            np.float32
+        )  # Important to transform count to probabilities to keep the convolution constant.
 
-    if len(counts_gene) < min_knn:
-        emd = 0
-    else:
-        x_conv, y_conv = compute_conv_idx(counts_gene, knn, p_zeros)
-        x_conv, emd = calculate_emd(knn_counts, x_conv, y_conv, n_divisions)
+        # We are calculating the convolution of cells with positive expression. Thus, in the first distribution
+        # we have to remove the cells with 0 reads, and rescale the probabilities.
+        # y_probs MUST have the probs of P(X=0) because the random neighbors might have 0 counts.
+        y_probs = y_probs_0 * np.float32(1 - p_zeros)
+        y_probs[0] = p_zeros
 
-    return emd
+        list_y_probs_0.append(y_probs_0)
+        list_y_probs.append(y_probs)
+        list_knn_counts.append(knn_counts)
+
+    array_emd = np.zeros(len(idx_genes), dtype=np.float64)
+
+    # Final support of the chain: len(y_probs_0) + knn * (len(y_probs) - 1).
+    lens_conv = np.array(
+        [(knn + 1) * len(y0) - knn for y0 in list_y_probs_0], dtype=np.int64
+    )
+    n_ffts = 2 ** np.ceil(np.log2(lens_conv)).astype(np.int64)
+
+    for n_fft in np.unique(n_ffts):
+        sel = np.where(n_ffts == n_fft)[0]
+        max_support = max(len(list_y_probs_0[j]) for j in sel)
+
+        stack_0 = np.zeros((len(sel), max_support), dtype=np.float32)
+        stack_probs = np.zeros((len(sel), max_support), dtype=np.float32)
+        for row, j in enumerate(sel):
+            stack_0[row, : len(list_y_probs_0[j])] = list_y_probs_0[j]
+            stack_probs[row, : len(list_y_probs[j])] = list_y_probs[j]
+
+        arr_conv = sfft.irfft(
+            sfft.rfft(stack_0, n=n_fft, axis=1)
+            * sfft.rfft(stack_probs, n=n_fft, axis=1) ** knn,
+            n=n_fft,
+            axis=1,
+        )
+
+        for row, j in enumerate(sel):
+            arr_prob = arr_conv[row, : lens_conv[j]]
+            # Important because the FFT round-off yields negative close-to-zero values that break emd
+            arr_prob[arr_prob < 1e-8] = 0
+            arr_prob /= (
+                arr_prob.sum()
+            )  # This is just in case the sum is bigger than 1
+
+            _, array_emd[j] = calculate_emd(
+                list_knn_counts[j],
+                np.arange(lens_conv[j]),
+                arr_prob,
+                n_divisions,
+            )
+
+    return array_emd
 
 
 def emd_calculation(
@@ -349,35 +701,52 @@ def emd_calculation(
     n_divisions: int,
 ) -> Tuple[list, list, np.ndarray]:
     """
-    Calculation of convolution for each gene, and its emd. To do that we call compute_convolution_and_emd which,
-    in turn, calls compute_conv_idx to calculate the convolution of the reads; and calculate_emd, to calculate the
-    emd between the convolution and the knn_counts.
+    Calculation of convolution for each gene, and its emd. The convolution of the reads is
+    calculated against the knn_counts distribution with calculate_emd / normalized_emd.
 
     Since we are working with counts of each gene, instead of each cell, we will get the csc forms of array_knn_counts and array_counts.
     This conversion takes some time and memory, but it does save a lot of time afterwards, when doing the column indexing.
     e.g. with a 50000 x 10000 matrix, doing csr -> csc and csc indexing takes 8s, whereas doing csr indexing takes 30 mins!!
 
-    To make things faster we use ray parallelization. Ray selects the counts and knn counts on each gene, and computes
-    the convolution and distance. The output result is, for each gene, the convolution distribution
-    (x, and probabilities), and the distances.
+    To make things faster we parallelize over genes with a numba prange kernel that works on the raw
+    csc attributes directly. The per-gene work is millisecond-scale, so process-based parallelization
+    (e.g. ray, which we used in 1.x) spends more time serializing the arrays than computing; the numba
+    kernel keeps everything in shared memory with ~zero per-task overhead. Genes with a count support
+    too long for the direct convolution kernel are flagged by the kernel and computed here with the
+    batched FFT path (see batched_fft_emd).
     """
-    n_genes = array_counts_csc.shape[1]
-
     triku_logger.log(TRIKU_LEVEL, "Running EMD calulation.")
 
-    list_emd = [
-        compute_convolution_and_emd(
+    # The binning of the counts to integers (the n_divisions scaling) is applied
+    # to the whole data attributes here, vectorized and contiguous, instead of
+    # once per gene inside the loops.
+    counts_data = (array_counts_csc.data * n_divisions).astype(np.int64)
+    knn_data = (array_knn_counts_csc.data * n_divisions).astype(np.int64)
+
+    array_emd = parallel_emd_calculation(
+        counts_data,
+        array_counts_csc.indices,
+        array_counts_csc.indptr,
+        knn_data,
+        array_knn_counts_csc.indices,
+        array_knn_counts_csc.indptr,
+        array_counts_csc.shape[0],
+        knn,
+        min_knn,
+        n_divisions,
+    )
+
+    idx_fallback = np.where(array_emd == -1.0)[0]
+    if len(idx_fallback) > 0:
+        array_emd[idx_fallback] = batched_fft_emd(
             array_counts_csc,
             array_knn_counts_csc,
-            idx_gene,
+            counts_data,
+            knn_data,
+            idx_fallback,
             knn,
-            min_knn,
             n_divisions,
         )
-        for idx_gene in range(n_genes)
-    ]
-
-    array_emd = np.array(list_emd)
 
     # In some cases, when knn_counts or counts is 0, emd is inf or nan. This should not happen because those genes are filtered, but
     # in some cases the filter migh not work. To not yield errors, we add this.
@@ -397,17 +766,30 @@ def subtract_median(x, y, n_windows, distance_correction):
     linspace = 10 ** np.linspace(
         np.min(np.log10(x)), np.max(np.log10(x)), n_windows + 1
     )
-    y_adjust = y.copy()
 
-    y_median_array = np.zeros(len(y))
+    # Masking all genes once per window is O(n_windows * n_genes). Instead, each gene is
+    # assigned its window index once with a digitize (genes on a boundary go to the upper
+    # window, as with the overwriting masks before), the genes are grouped by window with
+    # one argsort, and the correction is gathered back in a single indexing pass.
+    window_idx = np.clip(np.digitize(x, linspace) - 1, 0, n_windows - 1)
+
+    order = np.argsort(window_idx, kind="stable")
+    boundaries = np.searchsorted(window_idx[order], np.arange(n_windows + 1))
+
+    window_correction = np.zeros(n_windows)
     for i in range(n_windows):
-        mask = (x >= linspace[i]) & (x <= linspace[i + 1])
+        values = y[order[boundaries[i] : boundaries[i + 1]]]
+        if len(values) == 0:
+            continue
         if distance_correction == "median":
-            y_median_array[mask] = np.median(y[mask])
+            # bottleneck.median selects with quickselect instead of sorting
+            # the window; same result as np.median, including the averaging
+            # of the two central values for even-sized windows.
+            window_correction[i] = bottleneck.median(values)
         elif distance_correction == "mean":
-            y_median_array[mask] = np.mean(y[mask])
+            window_correction[i] = np.mean(values)
 
-    y_adjust -= y_median_array
+    y_adjust = y - window_correction[window_idx]
 
     return y_adjust
 
@@ -427,25 +809,23 @@ def get_cutoff_curve(y, s) -> float:
     min_y, max_y = np.min(y), np.max(y)
     m, b = (max_y - min_y) / len(y), min_y
 
-    list_d = []
-
-    for u, v in enumerate(np.sort(y)):
-        x_opt = (u - m * b + m * v) / (1 + m ** 2)
-        y_opt = x_opt * m + b
-        d = (x_opt - u) ** 2 + (y_opt - v) ** 2
+    y_sort = np.sort(y)
+    u = np.arange(len(y_sort))
 
-        list_d.append(d)
+    x_opt = (u - m * b + m * y_sort) / (1 + m ** 2)
+    y_opt = x_opt * m + b
+    arr_d = (x_opt - u) ** 2 + (y_opt - y_sort) ** 2
 
     # S is a corrector factor. It leverages the best value in the curve, and selects a more or less stringent
     # value in the curve. the maximum distance is multiplied by (1 - S), and the leftmost or rightmost index
     # is selected
 
-    dist_s = (1 - np.abs(s)) * np.max(list_d)
-    s_idx = np.argwhere(list_d >= dist_s)
+    dist_s = (1 - np.abs(s)) * np.max(arr_d)
+    s_idx = np.argwhere(arr_d >= dist_s)
 
     if s >= 0:
         max_d_idx = np.max(s_idx)
     else:
         max_d_idx = np.min(s_idx)
 
-    return np.sort(y)[max_d_idx]
+    return y_sort[max_d_idx]